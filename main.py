@@ -1,15 +1,22 @@
 import os
 import sys
-import json
 import asyncio
+import heapq
 import logging
 import time
-import html
-from datetime import datetime
+import re
+import ssl
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timezone
+from dataclasses import dataclass
+from typing import Optional
 from email.utils import parseaddr
-from base64 import urlsafe_b64decode
+from base64 import b64decode, urlsafe_b64decode
 from email.header import decode_header
 
+import orjson
+from aiohttp import web
 from aiogram import Bot, Dispatcher, F
 from aiogram.types import (
     InlineKeyboardButton,
@@ -18,10 +25,17 @@ from aiogram.types import (
     CallbackQuery,
 )
 from aiogram.client.default import DefaultBotProperties
+from aiogram.exceptions import TelegramBadRequest
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.fsm.context import FSMContext
+from aiogram.fsm.state import State, StatesGroup
 
+from google.auth.transport.requests import Request
+from google.oauth2 import id_token
 from google.oauth2.credentials import Credentials
 from google_auth_oauthlib.flow import InstalledAppFlow
 from googleapiclient.discovery import build
+from googleapiclient.errors import HttpError
 
 # ─── CONFIG & STATE FILES ─────────────────────────────────────────────────
 _pending_flows: dict[int, InstalledAppFlow] = {}
@@ -40,6 +54,36 @@ ALLOWED_GROUPS_FILE  = "allowed_groups.json"  # auto-populated
 POLL_INTERVAL        = 60        # seconds
 FIRST_REMINDER       = 60        # seconds
 LOOP_REMINDER        = 5 * 60    # seconds
+BATCH_LIMIT          = 50        # sub-requests per Gmail batch (hard cap 100)
+BATCH_RETRIES        = 3         # re-sends of rate-limited sub-requests
+FETCH_ATTEMPTS       = 5         # poll ticks a message may fail to fetch before it is skipped
+STORE_FLUSH_DELAY    = 2         # seconds
+QUERY_LIMIT          = 1000      # max chars per Gmail search string
+IO_WORKERS           = 8         # threads for blocking Gmail and file I/O
+TG_CONN_LIMIT        = 30        # pooled connections to the Telegram API
+TG_KEEPALIVE         = 75        # seconds an idle Telegram connection is kept
+TG_TEXT_LIMIT        = 4000      # Telegram rejects texts over 4096 UTF-16 units; keep a margin
+
+# Gmail push (optional): set PUSH_TOPIC to a Pub/Sub topic Gmail may publish
+# to and point a push subscription at https://<public-host>/PUSH_PATH. Pub/Sub
+# only pushes to public HTTPS with a CA-signed certificate, so either put a
+# TLS-terminating reverse proxy in front of PUSH_HOST:PUSH_PORT or set
+# PUSH_TLS_CERT/PUSH_TLS_KEY. Polling keeps running as a fallback. The webhook
+# refuses to start without PUSH_AUDIENCE and PUSH_SERVICE_ACCOUNT unless
+# PUSH_INSECURE is set.
+PUSH_TOPIC           = None      # e.g. "projects/my-project/topics/gmail"
+PUSH_HOST            = "0.0.0.0"
+PUSH_PORT            = 8080
+PUSH_PATH            = "/gmail/push"
+PUSH_TLS_CERT        = None      # PEM certificate chain, when serving HTTPS directly
+PUSH_TLS_KEY         = None      # its private key
+PUSH_AUDIENCE        = None      # audience of the subscription's OIDC token
+PUSH_SERVICE_ACCOUNT = None      # service account the subscription signs tokens as
+PUSH_INSECURE        = False     # accept unauthenticated pushes (trusted networks only)
+PUSH_MIN_GAP         = 10        # seconds between push-triggered syncs
+WATCH_MARGIN         = 24 * 3600 # seconds before expiry to renew the Gmail watch
+WATCH_RETRY          = 3600      # seconds before retrying a watch Gmail refused
+CREDS_MARGIN         = 5 * 60    # seconds before expiry to refresh the access token
 
 logging.basicConfig(
     level=logging.INFO,
@@ -53,85 +97,445 @@ for fn in (CLIENT_SECRETS, APIKEY_FILE, ADMIN_FILE):
         sys.exit(f"Error: {fn} not found, follow the readme for instructions.")
 
 # ─── BOT INIT ─────────────────────────────────────────────────────────────────
+# aiohttp drops idle sockets after 15s by default, so a burst of notifications
+# after a quiet minute would pay a fresh TLS handshake; AiohttpSession has no
+# public knob for this, hence the connector kwargs
+session = AiohttpSession(limit=TG_CONN_LIMIT)
+session._connector_init.update(keepalive_timeout=TG_KEEPALIVE)
+
+with open(APIKEY_FILE, encoding="utf-8") as f:
+    api_token = f.read().strip()
+
 bot = Bot(
-    token=open(APIKEY_FILE, encoding="utf-8").read().strip(),
+    token=api_token,
+    session=session,
     default=DefaultBotProperties(parse_mode="HTML"),
 )
 dp = Dispatcher()
 
 # ensure dynamic JSON files exist
-open(ALLOWED_GROUPS_FILE,  "a").close()
-open(WHITELIST_FILE,       "a").close()
-open(UNREAD_STORE_FILE,    "a").close()
+for fn in (ALLOWED_GROUPS_FILE, WHITELIST_FILE, UNREAD_STORE_FILE):
+    if not os.path.exists(fn):
+        open(fn, "x").close()
 
 # ─── GLOBAL STATE ─────────────────────────────────────────────────────────────
-CHAT_ID            = None
-_poll_task         = None
-_reminder_tasks    = {}     # gmail_msg_id → asyncio.Task
-last_checked_ts    = 0      # milliseconds since epoch
-
-# whitelist-management flags
-_adding, _removing = False, False
-_remove_index      = None
+# everything about the current Gmail ↔ chat binding; all but poll_task is
+# persisted to STATE_FILE
+@dataclass
+class BotState:
+    chat_id:         Optional[int] = None
+    last_checked_ts: int = 0                 # milliseconds since epoch
+    last_history_id: Optional[str] = None    # Gmail historyId of the last sync
+    watch_due:       float = 0               # when to (re)issue the Gmail watch, epoch seconds
+    poll_task:       Optional[asyncio.Task] = None
+
+PERSISTED_STATE = ("chat_id", "last_checked_ts", "last_history_id", "watch_due")
+
+bot_state          = BotState()
+_reminder_task     = None
+_creds_task        = None
+_reminders         = []     # heap of (due_ts, gmail_msg_id, stage)
+_reminder_wakeup   = None     # asyncio.Event, see main()
+unread_store       = {}     # gmail_msg_id → {"tg_msg_id", "time"}
+_store_writer      = None   # pending debounced save of unread_store
+_fetch_failures    = {}     # gmail_msg_id → ticks it failed to fetch
+_poll_wakeup       = None     # asyncio.Event set by the push webhook, see main()
+
+# Gmail client cache, rebuilt only when CREDENTIALS_FILE changes on disk
+_svc_cache         = None
+_creds_cache       = None
+_creds_mtime       = 0
+
+# parsed whitelist, keyed by the file's mtime: (mtime_ns, lines, emails, domains)
+_wl_cache          = (None, (), frozenset(), frozenset())
+_wl_lock           = None   # asyncio.Lock serializing whitelist edits, see main()
+
+# whitelist-management states, tracked per user and chat
+class WL(StatesGroup):
+    adding   = State()
+    removing = State()
 
 # ─── HELPERS ──────────────────────────────────────────────────────────────────
 def load_json(path, default):
-    if os.path.exists(path):
-        return json.load(open(path, encoding="utf-8"))
-    return default
+    try:
+        with open(path, "rb") as f:
+            raw = f.read()
+    except FileNotFoundError:
+        return default
+    return orjson.loads(raw) if raw else default
+
+# write to a temp file, fsync it and rename over the target, so readers
+# never see a half-written file and a crash never leaves a torn one
+def atomic_write(path: str, data: bytes):
+    tmp = path + ".tmp"
+    with open(tmp, "wb") as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
 
 def save_json(path, data):
-    with open(path, "w", encoding="utf-8") as f:
-        json.dump(data, f, indent=2, ensure_ascii=False)
+    atomic_write(path, orjson.dumps(
+        data, option=orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS
+    ))
+
+# saves from the loop run on the executor, one at a time per file, so an
+# older snapshot can never replace a newer one
+_save_locks: dict[str, asyncio.Lock] = {}
+
+async def save_json_async(path, data):
+    lock = _save_locks.setdefault(path, asyncio.Lock())
+    async with lock:
+        await asyncio.to_thread(save_json, path, data)
+
+async def save_state():
+    await save_json_async(
+        STATE_FILE, {k: getattr(bot_state, k) for k in PERSISTED_STATE}
+    )
+
+# coalesce any number of unread_store changes into one write
+def mark_store_dirty():
+    global _store_writer
+    if _store_writer is None:
+        _store_writer = asyncio.create_task(flush_store())
 
-def save_state():
-    save_json(STATE_FILE, {
-        "chat_id":         CHAT_ID,
-        "last_checked_ts": last_checked_ts
-    })
+async def flush_store():
+    global _store_writer
+    await asyncio.sleep(STORE_FLUSH_DELAY)
+    _store_writer = None
+    try:
+        await save_json_async(UNREAD_STORE_FILE, dict(unread_store))
+    except Exception:
+        logger.exception("[store] save failed")
 
 def load_state():
     data = load_json(STATE_FILE, {})
-    return data.get("chat_id"), data.get("last_checked_ts")
+    for k in PERSISTED_STATE:
+        if data.get(k) is not None:
+            setattr(bot_state, k, data[k])
+
+def load_wl():
+    try:
+        mtime = os.stat(WHITELIST_FILE).st_mtime_ns
+    except FileNotFoundError:
+        return (), frozenset(), frozenset()
+    if mtime != _wl_cache[0]:
+        with open(WHITELIST_FILE, encoding="utf-8") as f:
+            cache_wl(mtime, f.read().splitlines())
+    return _wl_cache[1:]
+
+def cache_wl(mtime: int, lines):
+    global _wl_cache
+    lines     = tuple(lines)
+    email_wl  = frozenset(e.lower() for e in lines if not e.startswith("*@"))
+    domain_wl = frozenset(e[2:].lower() for e in lines if e.startswith("*@"))
+    _wl_cache = (mtime, lines, email_wl, domain_wl)
+
+def invalidate_wl():
+    global _wl_cache
+    _wl_cache = (None, (), frozenset(), frozenset())
+
+def append_wl(entry: str):
+    with open(WHITELIST_FILE, "a", encoding="utf-8") as f:
+        f.write(entry + "\n")
+    invalidate_wl()
+
+# we wrote the whole file, so the new lines can be cached as-is
+def write_wl(lines):
+    atomic_write(WHITELIST_FILE, "".join(e + "\n" for e in lines).encode("utf-8"))
+    cache_wl(os.stat(WHITELIST_FILE).st_mtime_ns, lines)
+
+def remove_files(*paths):
+    for fn in paths:
+        try: os.remove(fn)
+        except: pass
+
+# same output as html.escape(), in one C-level pass instead of five replaces
+_HTML_TT = str.maketrans({
+    "&": "&amp;", "<": "&lt;", ">": "&gt;", '"': "&quot;", "'": "&#x27;",
+})
+
+def esc(text: str) -> str:
+    return text.translate(_HTML_TT)
 
 def strike(text: str) -> str:
-    return "".join(ch + "\u0336" for ch in text)
+    return "\u0336".join(text) + "\u0336" if text else ""
+
+# Telegram measures text in UTF-16 code units, so astral characters count twice
+def tg_len(text: str) -> int:
+    return len(text.encode("utf-16-le")) // 2
+
+def tg_cut(text: str, limit: int) -> str:
+    if tg_len(text) <= limit:
+        return text
+    # a surrogate pair split at the cut is dropped by errors="ignore"
+    cut = text.encode("utf-16-le")[:max(limit - 1, 0) * 2]
+    return cut.decode("utf-16-le", errors="ignore") + "…"
+
+# Telegram rejections caused by the message itself; any other 400 (no rights
+# in the chat, chat not found, ...) would hit every message alike
+_MSG_REJECTIONS = (
+    "message is too long",
+    "can't parse entities",
+    "text must be non-empty",
+    "message text is empty",
+)
+
+def message_rejected(exc: TelegramBadRequest) -> bool:
+    msg = exc.message.lower()
+    return any(r in msg for r in _MSG_REJECTIONS)
 
 def format_ts(ms: int) -> str:
-    return datetime.fromtimestamp(ms / 1000).strftime("%H:%M %d.%m")
+    t = time.localtime(ms // 1000)
+    return f"{t.tm_hour:02d}:{t.tm_min:02d} {t.tm_mday:02d}.{t.tm_mon:02d}"
+
+def save_credentials(creds):
+    atomic_write(CREDENTIALS_FILE, creds.to_json().encode("utf-8"))
 
 def get_service():
+    global _svc_cache, _creds_cache, _creds_mtime
     if not os.path.exists(CREDENTIALS_FILE):
         raise RuntimeError("Not authorized — run /start then /auth first.")
-    info  = json.load(open(CREDENTIALS_FILE, encoding="utf-8"))
-    creds = Credentials.from_authorized_user_info(info, SCOPES)
-    return build("gmail", "v1", credentials=creds, cache_discovery=False)
-
-def fetch_body(msg_id: str) -> str:
-    svc = get_service()
-    msg = svc.users().messages().get(
-        userId="me", id=msg_id, format="full"
-    ).execute()
-
-    def walk(parts):
-        for p in parts or []:
-            if p.get("mimeType") == "text/plain" and p.get("body", {}).get("data"):
-                return urlsafe_b64decode(p["body"]["data"]).decode(errors="ignore")
-            if p.get("parts"):
-                r = walk(p["parts"])
-                if r:
-                    return r
-        return None
-
-    plain = walk(msg.get("payload", {}).get("parts"))
-    return (plain or msg.get("snippet", "")).strip()
+
+    mtime = os.stat(CREDENTIALS_FILE).st_mtime_ns
+    if _svc_cache is None or mtime != _creds_mtime:
+        info         = load_json(CREDENTIALS_FILE, {})
+        _creds_cache = Credentials.from_authorized_user_info(info, SCOPES)
+        _svc_cache   = build("gmail", "v1", credentials=_creds_cache,
+                             cache_discovery=False)
+        _creds_mtime = mtime
+
+    # normally creds_refresh_loop got here first; this catches a token
+    # that expired while the loop was backing off
+    if _creds_cache.expired and _creds_cache.refresh_token:
+        refresh_creds(_creds_cache)
+    return _svc_cache
+
+# the service holds a reference to _creds_cache, so refreshing in place
+# is enough to update its auth header
+def refresh_creds(creds):
+    global _creds_mtime
+    if creds is not _creds_cache:
+        return   # replaced by a new /auth meanwhile
+    creds.refresh(Request())
+    if creds is not _creds_cache:
+        return   # replaced or dropped during the round trip
+    save_credentials(creds)
+    _creds_mtime = os.stat(CREDENTIALS_FILE).st_mtime_ns
+
+def reset_service():
+    global _svc_cache, _creds_cache, _creds_mtime
+    _svc_cache, _creds_cache, _creds_mtime = None, None, 0
+
+# credentials.json is also written by refresh_creds, so replacing or
+# deleting it goes through gmail_call too, never racing a refresh
+def install_credentials(creds):
+    save_credentials(creds)
+    reset_service()
+
+def drop_credentials(*paths):
+    remove_files(CREDENTIALS_FILE, *paths)
+    reset_service()
+
+WANTED_HEADERS = frozenset(("From", "Subject"))
+
+# partial response for the poll batch: just what poll_loop and extract_body
+# read (ids, date, snippet, top-level headers, part types and inline data),
+# leaving out labels, sizes, thread ids and per-part headers
+MESSAGE_FIELDS = (
+    "id,internalDate,snippet,"
+    "payload(headers,mimeType,body/data,"
+    "parts(mimeType,body/data,parts(mimeType,body/data,parts)))"
+)
+
+def pick_headers(headers: list[dict]) -> dict[str, str]:
+    hdrs = {}
+    for h in headers:
+        name = h["name"]
+        if name in WANTED_HEADERS:
+            hdrs[name] = h["value"]
+    return hdrs
+
+# plain `Name <user@host>` and bare `user@host` headers skip the full
+# RFC 2822 parser; quoted names and address lists still need it
+_FROM_RE = re.compile(r"<([^\s<>@]+@[^\s<>@]+)>\s*$|^\s*([^\s<>@]+@[^\s<>@]+)\s*$")
+
+def fast_addr(value: str) -> str:
+    if '"' not in value and "," not in value:
+        m = _FROM_RE.search(value)
+        if m:
+            return m.group(1) or m.group(2)
+    return parseaddr(value)[1]
+
+# a bogus charset or undecodable bytes must not abort the whole poll tick
+def decode_subject(raw: str) -> str:
+    if "=?" not in raw:
+        return raw
+    try:
+        return "".join(
+            part.decode(enc or "utf-8", errors="replace") if isinstance(part, bytes) else part
+            for part, enc in decode_header(raw)
+        )
+    except LookupError:
+        return raw
+
+def extract_body(msg: dict) -> str:
+    # depth-first, in document order, stopping at the first text/plain part
+    stack = [msg.get("payload", {})]
+    while stack:
+        p    = stack.pop()
+        data = p.get("body", {}).get("data")
+        if p.get("mimeType") == "text/plain" and data:
+            return urlsafe_b64decode(data).decode(errors="ignore").strip()
+        stack.extend(reversed(p.get("parts") or []))
+    return msg.get("snippet", "").strip()
+
+# per-user quota errors come back as 403 rather than 429
+_RATE_LIMIT_REASONS = (b'"rateLimitExceeded"', b'"userRateLimitExceeded"')
+
+def retryable(exc: Exception) -> bool:
+    if not isinstance(exc, HttpError):
+        return False
+    status = exc.resp.status
+    if status in (429, 500, 503):
+        return True
+    return status == 403 and any(r in (exc.content or b"") for r in _RATE_LIMIT_REASONS)
+
+def run_batches(svc, ids: list[str], collect, params: dict):
+    for i in range(0, len(ids), BATCH_LIMIT):
+        batch = svc.new_batch_http_request(callback=collect)
+        for gid in ids[i:i + BATCH_LIMIT]:
+            batch.add(
+                svc.users().messages().get(userId="me", id=gid, **params),
+                request_id=gid
+            )
+        batch.execute()
+
+# fetch many messages in as few HTTP round trips as Gmail allows; Gmail
+# rate-limits individual sub-requests of big batches, so those are re-sent
+# with backoff (slept outside the Gmail lock). Returns the fetched messages
+# and the ids that could not be fetched; deleted messages (404) are neither
+async def batch_get(svc, ids: list[str], **params) -> tuple[dict[str, dict], list[str]]:
+    results, retry, failed = {}, [], []
+
+    def collect(request_id, response, exception):
+        if exception is None:
+            results[request_id] = response
+        elif retryable(exception):
+            retry.append(request_id)
+        elif not (isinstance(exception, HttpError) and exception.resp.status == 404):
+            logger.warning("[batch] get %s failed: %s", request_id, exception)
+            failed.append(request_id)
+
+    pending = list(ids)
+    for attempt in range(BATCH_RETRIES + 1):
+        await gmail_call(run_batches, svc, pending, collect, params)
+        if not retry:
+            break
+        if attempt == BATCH_RETRIES:
+            logger.warning("[batch] giving up on %d rate-limited gets", len(retry))
+            failed += retry
+            break
+        pending, retry = retry, []
+        await asyncio.sleep(2 ** attempt)
+    return results, failed
+
+# Gmail search strings matching the whitelisted senders, split so none
+# exceeds QUERY_LIMIT; an empty whitelist needs no search at all
+def wl_queries(email_wl, domain_wl) -> list[str]:
+    terms = [f"from:{e}" for e in sorted(email_wl)]
+    terms += [f"from:{d}" for d in sorted(domain_wl)]
+    chunks, chunk, size = [], [], 0
+    for term in terms:
+        if chunk and size + len(term) > QUERY_LIMIT:
+            chunks.append(chunk)
+            chunk, size = [], 0
+        chunk.append(term)
+        size += len(term) + len(" OR ")
+    if chunk:
+        chunks.append(chunk)
+    return [f"is:unread ({' OR '.join(c)})" for c in chunks]
+
+# full scan of the unread inbox, plus the historyId to sync from next time
+def list_unread(svc, queries: list[str]) -> tuple[list[str], str]:
+    history_id = svc.users().getProfile(userId="me").execute()["historyId"]
+    ids = []
+    for q in queries:
+        resp = svc.users().messages().list(
+            userId="me", labelIds=["INBOX"], q=q
+        ).execute()
+        ids += [m["id"] for m in resp.get("messages", []) if m["id"] not in ids]
+    return ids, history_id
+
+# ids of unread inbox messages added since start_id, ids that lost their
+# UNREAD label (read in another client) and the new historyId; raises
+# HttpError 404 once Gmail no longer keeps history that far back
+def list_history(svc, start_id: str) -> tuple[list[str], set[str], str]:
+    ids, read_ids, token = [], set(), None
+    while True:
+        resp = svc.users().history().list(
+            userId="me", startHistoryId=start_id, labelId="INBOX",
+            historyTypes=["messageAdded", "labelRemoved"], pageToken=token
+        ).execute()
+        for h in resp.get("history", []):
+            for added in h.get("messagesAdded", []):
+                m = added["message"]
+                if "UNREAD" in m.get("labelIds", []) and m["id"] not in ids:
+                    ids.append(m["id"])
+            for removed in h.get("labelsRemoved", []):
+                if "UNREAD" in removed.get("labelIds", []):
+                    read_ids.add(removed["message"]["id"])
+        token = resp.get("nextPageToken")
+        if not token:
+            return ids, read_ids, resp["historyId"]
+
+# googleapiclient is blocking and httplib2 is not thread-safe, so Gmail
+# calls run on a worker thread, one at a time, keeping the event loop free
+_gmail_lock = None   # asyncio.Lock, see main()
+
+async def gmail_call(fn, *args, **kwargs):
+    async with _gmail_lock:
+        return await asyncio.to_thread(fn, *args, **kwargs)
+
+async def gmail_exec(req):
+    return await gmail_call(req.execute)
+
+# refresh the access token ahead of its expiry, so the token round trip
+# never lands on a poll; CREDS_MARGIN stays above google-auth's own
+# early-expiry window, otherwise get_service would always win the race
+async def creds_refresh_loop():
+    while True:
+        creds = _creds_cache
+        if creds is None or creds.expiry is None or not creds.refresh_token:
+            await asyncio.sleep(POLL_INTERVAL)   # not loaded by get_service yet
+            continue
+        left = creds.expiry.replace(tzinfo=timezone.utc).timestamp() - time.time()
+        if left > CREDS_MARGIN:
+            await asyncio.sleep(left - CREDS_MARGIN)
+            continue
+        try:
+            await gmail_call(refresh_creds, creds)
+        except Exception:
+            logger.exception("[creds] refresh failed")
+            await asyncio.sleep(POLL_INTERVAL)
 
 # ─── ACCESS CONTROL ──────────────────────────────────────────────────────────
 admins         = set(load_json(ADMIN_FILE, []))
 allowed_groups = set(load_json(ALLOWED_GROUPS_FILE, []))
 
+_group_saves = set()   # running save tasks, kept referenced until done
+
+async def write_allowed_groups(groups: list):
+    try:
+        await save_json_async(ALLOWED_GROUPS_FILE, groups)
+    except Exception:
+        logger.exception("[groups] save failed")
+
+# is_authorized is sync but runs inside handlers, so the save is a task
 def save_allowed_groups():
-    save_json(ALLOWED_GROUPS_FILE, list(allowed_groups))
+    task = asyncio.create_task(write_allowed_groups(list(allowed_groups)))
+    _group_saves.add(task)
+    task.add_done_callback(_group_saves.discard)
 
 def is_admin(user_id: int) -> bool:
     return user_id in admins
@@ -148,28 +552,27 @@ def is_authorized(chat_id: int, user_id: int, chat_type: str) -> bool:
     return False
 
 # ─── INLINE KEYBOARDS ─────────────────────────────────────────────────────────
+# static keyboards are built once; aiogram validates every model on creation
+@lru_cache(maxsize=1024)
 def kb_read(gid: str):
     return InlineKeyboardMarkup(inline_keyboard=[[
         InlineKeyboardButton(text="Read", callback_data=f"mark_read:{gid}")
     ]])
 
-def kb_wl():
-    return InlineKeyboardMarkup(inline_keyboard=[[
-        InlineKeyboardButton(text="Add",    callback_data="wl_add"),
-        InlineKeyboardButton(text="Remove", callback_data="wl_remove"),
-    ]])
+KB_WL = InlineKeyboardMarkup(inline_keyboard=[[
+    InlineKeyboardButton(text="Add",    callback_data="wl_add"),
+    InlineKeyboardButton(text="Remove", callback_data="wl_remove"),
+]])
 
-def kb_confirm_remove():
-    return InlineKeyboardMarkup(inline_keyboard=[[
-        InlineKeyboardButton(text="Yes", callback_data="wl_confirm_remove"),
-        InlineKeyboardButton(text="No",  callback_data="wl_cancel_remove"),
-    ]])
+KB_CONFIRM_REMOVE = InlineKeyboardMarkup(inline_keyboard=[[
+    InlineKeyboardButton(text="Yes", callback_data="wl_confirm_remove"),
+    InlineKeyboardButton(text="No",  callback_data="wl_cancel_remove"),
+]])
 
-def kb_confirm_start():
-    return InlineKeyboardMarkup(inline_keyboard=[[
-        InlineKeyboardButton(text="Yes", callback_data="start_confirm_yes"),
-        InlineKeyboardButton(text="No",  callback_data="start_confirm_no"),
-    ]])
+KB_CONFIRM_START = InlineKeyboardMarkup(inline_keyboard=[[
+    InlineKeyboardButton(text="Yes", callback_data="start_confirm_yes"),
+    InlineKeyboardButton(text="No",  callback_data="start_confirm_no"),
+]])
 
 # ─── COMMAND: /rights ─────────────────────────────────────────────────────────
 @dp.message(F.text == "/rights")
@@ -185,7 +588,8 @@ async def cmd_start(msg: Message):
     if not is_admin(msg.from_user.id):
         return
 
-    auth_flow = InstalledAppFlow.from_client_secrets_file(
+    auth_flow = await asyncio.to_thread(
+        InstalledAppFlow.from_client_secrets_file,
         CLIENT_SECRETS,
         SCOPES,
         redirect_uri="urn:ietf:wg:oauth:2.0:oob"
@@ -215,27 +619,36 @@ async def cmd_auth(msg: Message):
     flow = _pending_flows.pop(user_id)
 
     try:
-        flow.fetch_token(code=code)
+        await asyncio.to_thread(flow.fetch_token, code=code)
     except Exception as e:
         return await msg.reply(f"❌ Token exchange failed:\n{e}")
 
-    creds = flow.credentials
-    with open(CREDENTIALS_FILE, "w", encoding="utf-8") as f:
-        f.write(creds.to_json())
+    await gmail_call(install_credentials, flow.credentials)
 
-    # Initialize whitelist and unread-store
-    open(WHITELIST_FILE,    "a").close()
-    save_json(UNREAD_STORE_FILE, {})
+    # Initialize whitelist and unread-store, touching disk only if needed
+    if not os.path.exists(WHITELIST_FILE):
+        await asyncio.to_thread(lambda: open(WHITELIST_FILE, "x").close())
+    if unread_store or not os.path.exists(UNREAD_STORE_FILE):
+        unread_store.clear()
+        await save_json_async(UNREAD_STORE_FILE, {})
 
     # Persist state and start polling
-    global CHAT_ID, _poll_task, last_checked_ts
-    CHAT_ID         = msg.chat.id
-    last_checked_ts = int(time.time() * 1000)
-    save_state()
-
-    if _poll_task:
-        _poll_task.cancel()
-    _poll_task = asyncio.create_task(poll_loop())
+    bot_state.chat_id         = msg.chat.id
+    bot_state.last_checked_ts = int(time.time() * 1000)
+    try:
+        svc = await gmail_call(get_service)
+        bot_state.last_history_id = (await gmail_exec(
+            svc.users().getProfile(userId="me")
+        ))["historyId"]
+    except Exception:
+        logger.exception("[auth] could not read historyId")
+        bot_state.last_history_id = None
+    bot_state.watch_due = 0
+    await save_state()
+
+    if bot_state.poll_task:
+        bot_state.poll_task.cancel()
+    bot_state.poll_task = asyncio.create_task(poll_loop())
 
     await msg.answer("✅ Authorization complete! I'll start notifying you of new emails.")
 
@@ -245,9 +658,8 @@ async def cb_start_yes(q: CallbackQuery):
     if not is_admin(q.from_user.id):
         return await q.answer("❌ Only admins.", show_alert=True)
 
-    for fn in (CREDENTIALS_FILE, UNREAD_STORE_FILE):
-        try: os.remove(fn)
-        except: pass
+    await gmail_call(drop_credentials, UNREAD_STORE_FILE)
+    unread_store.clear()
     await cmd_start(q.message)
 
 @dp.callback_query(F.data == "start_confirm_no")
@@ -257,9 +669,8 @@ async def cb_start_no(q: CallbackQuery):
 
     await q.answer("Keeping existing authorization.")
     # If we have valid creds, resume polling
-    global _poll_task
-    if not _poll_task and os.path.exists(CREDENTIALS_FILE):
-        _poll_task = asyncio.create_task(poll_loop())
+    if not bot_state.poll_task and os.path.exists(CREDENTIALS_FILE):
+        bot_state.poll_task = asyncio.create_task(poll_loop())
 
 # ─── COMMAND: /restart (admin only) ──────────────────────────────────────────
 @dp.message(F.text == "/restart")
@@ -267,103 +678,108 @@ async def cmd_restart(msg: Message):
     if not is_admin(msg.from_user.id):
         return await msg.reply("❌ Only admins can reset the bot.")
 
-    for fn in (CREDENTIALS_FILE, WHITELIST_FILE,
-               UNREAD_STORE_FILE, STATE_FILE):
-        try: os.remove(fn)
-        except: pass
-    for t in _reminder_tasks.values():
-        t.cancel()
-    _reminder_tasks.clear()
+    await gmail_call(drop_credentials, WHITELIST_FILE, UNREAD_STORE_FILE, STATE_FILE)
+    unread_store.clear()
+    _reminders.clear()
 
-    global _poll_task
-    if _poll_task:
-        _poll_task.cancel()
-        _poll_task = None
+    if bot_state.poll_task:
+        bot_state.poll_task.cancel()
+        bot_state.poll_task = None
 
     await msg.answer("🔄 Bot reset. Re-run /start to authorize again.")
 
 # ─── COMMAND: /whitelist ──────────────────────────────────────────────────────
 @dp.message(F.text == "/whitelist")
-async def cmd_whitelist(msg: Message):
+async def cmd_whitelist(msg: Message, state: FSMContext):
     if not is_authorized(msg.chat.id, msg.from_user.id, msg.chat.type):
         return await msg.reply("❌ You’re not allowed here.")
 
-    global _adding, _removing
-    _adding = _removing = False
+    await state.clear()
 
-    lines = open(WHITELIST_FILE, encoding="utf-8").read().splitlines()
+    lines = (await asyncio.to_thread(load_wl))[0]
     if not lines:
         text = "Whitelist is empty."
     else:
-        text = "\n".join(f"{i+1}. {html.escape(e)}" for i,e in enumerate(lines))
+        text = "\n".join(f"{i+1}. {esc(e)}" for i,e in enumerate(lines))
 
-    await msg.answer(text, reply_markup=kb_wl())
+    await msg.answer(text, reply_markup=KB_WL)
 
 @dp.callback_query(F.data == "wl_add")
-async def cb_wl_add(q: CallbackQuery):
+async def cb_wl_add(q: CallbackQuery, state: FSMContext):
     if not is_authorized(q.message.chat.id, q.from_user.id, q.message.chat.type):
         return await q.answer("❌ Not allowed here.", show_alert=True)
-    global _adding, _removing
-    _adding, _removing = True, False
+    await state.set_state(WL.adding)
     await q.answer("Send the email or domain to ADD (e.g. user@domain.com or *@domain.com).")
 
 @dp.callback_query(F.data == "wl_remove")
-async def cb_wl_remove(q: CallbackQuery):
+async def cb_wl_remove(q: CallbackQuery, state: FSMContext):
     if not is_authorized(q.message.chat.id, q.from_user.id, q.message.chat.type):
         return await q.answer("❌ Not allowed here.", show_alert=True)
 
-    lines = open(WHITELIST_FILE, encoding="utf-8").read().splitlines()
-    if not lines:
+    if not (await asyncio.to_thread(load_wl))[0]:
         return await q.answer("Whitelist is empty.", show_alert=True)
 
-    global _adding, _removing
-    _adding, _removing = False, True
+    await state.set_state(WL.removing)
     await q.answer("Send the number of the entry to REMOVE.")
 
-@dp.message(lambda m: _adding)
-async def on_add(m: Message):
-    global _adding
+@dp.message(WL.adding, F.text)
+async def on_add(m: Message, state: FSMContext):
     entry = m.text.strip()
     if "@" not in entry:
         return await m.reply("❌ Invalid format.")
-    with open(WHITELIST_FILE, "a", encoding="utf-8") as f:
-        f.write(entry + "\n")
-    _adding = False
-    await m.reply(f"➕ Added `{html.escape(entry)}`.", parse_mode="Markdown")
+    async with _wl_lock:
+        await asyncio.to_thread(append_wl, entry)
+    await state.clear()
+    await m.reply(f"➕ Added `{esc(entry)}`.", parse_mode="Markdown")
 
-@dp.message(lambda m: _removing)
-async def on_remove(m: Message):
-    global _removing, _remove_index
+@dp.message(WL.removing, F.text)
+async def on_remove(m: Message, state: FSMContext):
     idx = m.text.strip()
     if not idx.isdigit():
         return await m.reply("❌ Send a number.")
-    lines = open(WHITELIST_FILE, encoding="utf-8").read().splitlines()
+    lines = (await asyncio.to_thread(load_wl))[0]
     i = int(idx) - 1
     if i < 0 or i >= len(lines):
         return await m.reply("❌ Invalid index.")
-    _remove_index, _removing = i, False
+    await state.set_state(None)
+    await state.set_data({"remove_index": i, "remove_entry": lines[i]})
     await m.reply(
-        f"Remove `{html.escape(lines[i])}`?",
-        reply_markup=kb_confirm_remove(),
+        f"Remove `{esc(lines[i])}`?",
+        reply_markup=KB_CONFIRM_REMOVE,
         parse_mode="Markdown"
     )
 
 @dp.callback_query(F.data == "wl_confirm_remove")
-async def cb_confirm_remove(q: CallbackQuery):
+async def cb_confirm_remove(q: CallbackQuery, state: FSMContext):
     if not is_authorized(q.message.chat.id, q.from_user.id, q.message.chat.type):
         return await q.answer("❌ Not allowed.", show_alert=True)
 
-    lines = open(WHITELIST_FILE, encoding="utf-8").read().splitlines()
-    removed = lines.pop(_remove_index)
-    with open(WHITELIST_FILE, "w", encoding="utf-8") as f:
-        f.write("\n".join(lines) + ("\n" if lines else ""))
+    data = await state.get_data()
+    if "remove_entry" not in data:
+        return await q.answer("Nothing to remove.", show_alert=True)
+    await state.clear()
+
+    # the read-modify-write spans two thread hops; hold the lock so an
+    # add landing in between isn't overwritten
+    async with _wl_lock:
+        # served from the cache filled by on_remove unless the file changed since
+        lines   = list((await asyncio.to_thread(load_wl))[0])
+        removed = data["remove_entry"]
+        i       = data["remove_index"]
+        if i >= len(lines) or lines[i] != removed:
+            if removed not in lines:
+                return await q.answer("Entry is no longer in the whitelist.", show_alert=True)
+            i = lines.index(removed)
+        del lines[i]
+        await asyncio.to_thread(write_wl, lines)
     await q.answer("✅ Removed.")
-    await q.message.edit_text(f"❌ Removed `{html.escape(removed)}`.", parse_mode="Markdown")
+    await q.message.edit_text(f"❌ Removed `{esc(removed)}`.", parse_mode="Markdown")
 
 @dp.callback_query(F.data == "wl_cancel_remove")
-async def cb_cancel_remove(q: CallbackQuery):
+async def cb_cancel_remove(q: CallbackQuery, state: FSMContext):
     if not is_authorized(q.message.chat.id, q.from_user.id, q.message.chat.type):
         return await q.answer("❌ Not allowed.", show_alert=True)
+    await state.clear()
     await q.answer("Cancelled.")
 
 # ─── MARK‐AS‐READ CALLBACK ─────────────────────────────────────────────────────
@@ -373,116 +789,284 @@ async def cb_mark_read(q: CallbackQuery):
         return await q.answer("❌ Not allowed.", show_alert=True)
 
     gid = q.data.split(":", 1)[1]
-    svc = get_service()
-    svc.users().messages().modify(
+    svc = await gmail_call(get_service)
+    await gmail_exec(svc.users().messages().modify(
         userId="me", id=gid, body={"removeLabelIds": ["UNREAD"]}
-    ).execute()
+    ))
 
-    store = load_json(UNREAD_STORE_FILE, {})
-    info  = store.pop(gid, None)
-    save_json(UNREAD_STORE_FILE, store)
-    task = _reminder_tasks.pop(gid, None)
-    if task:
-        task.cancel()
+    unread_store.pop(gid, None)
+    mark_store_dirty()
 
     await q.message.edit_text(strike(q.message.text or ""))
     await q.answer("Marked as read.")
 
 # ─── POLLING & REMINDERS ─────────────────────────────────────────────────────
+async def send_notification(gid: str, text: str):
+    return await bot.send_message(
+        bot_state.chat_id, text,
+        parse_mode="HTML",
+        reply_markup=kb_read(gid)
+    )
+
 async def poll_loop():
     await asyncio.sleep(3)
-    global last_checked_ts
-
-    store = load_json(UNREAD_STORE_FILE, {})
+    st = bot_state
 
     while True:
+        started = time.monotonic()
         try:
-            svc = get_service()
-
-            entries   = open(WHITELIST_FILE, encoding="utf-8").read().splitlines()
-            email_wl  = {e for e in entries if not e.startswith("*@")}
-            domain_wl = {e[2:] for e in entries if e.startswith("*@")}
-
-            resp   = svc.users().messages().list(
-                userId="me", labelIds=["INBOX"], q="is:unread"
-            ).execute()
-            msgs   = resp.get("messages", [])
-            new_ts = last_checked_ts
-
-            for m in msgs:
-                gid    = m["id"]
-                detail = svc.users().messages().get(
-                    userId="me", id=gid, format="metadata",
-                    metadataHeaders=["From", "Date", "Subject"]
-                ).execute()
+            svc = await gmail_call(get_service)
+
+            # a broken push setup must not stop the sync below; polling
+            # alone still delivers everything, just later
+            if push_enabled() and time.time() >= st.watch_due:
+                try:
+                    watch = await gmail_exec(svc.users().watch(userId="me", body={
+                        "topicName": PUSH_TOPIC,
+                        "labelIds":  ["INBOX"],
+                    }))
+                    st.watch_due = int(watch["expiration"]) / 1000 - WATCH_MARGIN
+                    await save_state()
+                except Exception:
+                    logger.exception("[push] watch failed, retrying in %ss", WATCH_RETRY)
+                    st.watch_due = time.time() + WATCH_RETRY
+
+            _, email_wl, domain_wl = await asyncio.to_thread(load_wl)
+
+            ids, read_ids = None, set()
+            if st.last_history_id:
+                try:
+                    ids, read_ids, history_id = await gmail_call(
+                        list_history, svc, st.last_history_id
+                    )
+                except HttpError as e:
+                    if e.resp.status != 404:
+                        raise
+                    logger.warning("[poll] history expired, rescanning inbox")
+            if ids is None:
+                ids, history_id = await gmail_call(
+                    list_unread, svc, wl_queries(email_wl, domain_wl)
+                )
+            # arrived and read elsewhere within one interval: not worth a ping
+            ids = [gid for gid in ids if gid not in unread_store and gid not in read_ids]
+
+            # read elsewhere: forget them so their reminders are skipped
+            if any([unread_store.pop(gid, None) for gid in read_ids]):
+                mark_store_dirty()
+
+            details, unfetched = await batch_get(
+                svc, ids, format="full", fields=MESSAGE_FIELDS
+            )
+            # an unfetched message holds the sync point so it is retried,
+            # but one that never loads must not pin it forever
+            fetch_failed = False
+            for gid in unfetched:
+                tries = _fetch_failures.get(gid, 0) + 1
+                if tries < FETCH_ATTEMPTS:
+                    _fetch_failures[gid] = tries
+                    fetch_failed = True
+                    continue
+                logger.error("[poll] giving up on %s after %d failed fetches", gid, tries)
+                _fetch_failures.pop(gid, None)
+                unread_store[gid] = {"tg_msg_id": None, "time": time.time()}
+                mark_store_dirty()
+            for gid in details:
+                _fetch_failures.pop(gid, None)
+            new_ts  = st.last_checked_ts
+            outbox  = []            # (ts, gid, text) to notify this tick
+
+            for gid in ids:
+                detail = details.get(gid)
+                if detail is None:
+                    continue
 
                 ts = int(detail["internalDate"])
                 new_ts = max(new_ts, ts)
-                if ts <= last_checked_ts:
+                if ts <= st.last_checked_ts:
                     continue
 
-                hdrs        = {h["name"]: h["value"] for h in detail["payload"]["headers"]}
-                raw_subject = hdrs.get("Subject", "(no subject)")
-                parts       = decode_header(raw_subject)
-                subject     = "".join(
-                    part.decode(enc or "utf-8") if isinstance(part, bytes) else part
-                    for part, enc in parts
-                )
-
-                addr   = parseaddr(hdrs["From"])[1]
-                domain = addr.split("@", 1)[1]
-                allow  = addr in email_wl or domain in domain_wl
+                hdrs   = pick_headers(detail["payload"]["headers"])
+                addr   = fast_addr(hdrs.get("From", ""))
+                key    = addr.lower()
+                domain = key.partition("@")[2]
+                allow  = key in email_wl or domain in domain_wl
 
                 if not allow:
-                    store[gid] = {"tg_msg_id": None, "time": time.time()}
-                    save_json(UNREAD_STORE_FILE, store)
+                    unread_store[gid] = {"tg_msg_id": None, "time": time.time()}
+                    mark_store_dirty()
                     continue
 
-                body = fetch_body(gid)
+                subject = decode_subject(hdrs.get("Subject", "(no subject)"))
+                body    = extract_body(detail)
+                stamp   = format_ts(ts)
+                head    = f"📧 From: {addr}\n📝 Subject: {subject}\n\n"
+                # the limit counts text after HTML parsing, so measure unescaped
+                body = tg_cut(body, TG_TEXT_LIMIT - tg_len(head) - tg_len(stamp) - 1)
                 text = (
-                    f"📧 From: {html.escape(addr)}\n"
-                    f"📝 Subject: {html.escape(subject)}\n\n"
-                    f"{html.escape(body)}\n"
-                    f"{format_ts(ts)}"
+                    f"📧 From: {esc(addr)}\n"
+                    f"📝 Subject: {esc(subject)}\n\n"
+                    f"{esc(body)}\n"
+                    f"{stamp}"
                 )
 
-                sent = await bot.send_message(
-                    CHAT_ID, text,
-                    parse_mode="HTML",
-                    reply_markup=kb_read(gid)
-                )
-
-                store[gid] = {"tg_msg_id": sent.message_id, "time": time.time()}
-                save_json(UNREAD_STORE_FILE, store)
-
-                _reminder_tasks[gid] = asyncio.create_task(reminder_loop(gid))
-
-            last_checked_ts = new_ts
-            save_state()
+                outbox.append((ts, gid, text))
+
+            # Gmail lists newest first; everything goes to one chat, so send
+            # oldest first and one at a time, and stop at the first transient
+            # failure so the retry next tick doesn't land out of order
+            outbox.sort()
+            failed = fetch_failed
+            for _, gid, text in outbox:
+                try:
+                    sent = await send_notification(gid, text)
+                except TelegramBadRequest as e:
+                    if not message_rejected(e):
+                        logger.error("[poll] notifying %s failed: %s", gid, e)
+                        failed = True
+                        break
+                    # this message can never be sent: record it as seen
+                    # without a notification instead of blocking the sync
+                    logger.error("[poll] Telegram rejected %s: %s", gid, e)
+                    unread_store[gid] = {"tg_msg_id": None, "time": time.time()}
+                    continue
+                except Exception as e:
+                    logger.error("[poll] notifying %s failed: %s", gid, e)
+                    failed = True
+                    break
+                unread_store[gid] = {"tg_msg_id": sent.message_id, "time": time.time()}
+                schedule_reminder(gid, FIRST_REMINDER, 0)
+            if outbox:
+                mark_store_dirty()
+
+            # leave the sync point alone so failed fetches and sends are
+            # retried; the ones that went through are in unread_store and
+            # get skipped
+            if failed:
+                new_ts, history_id = st.last_checked_ts, st.last_history_id
+
+            if (new_ts, history_id) != (st.last_checked_ts, st.last_history_id):
+                st.last_checked_ts = new_ts
+                st.last_history_id = history_id
+                await save_state()
 
         except Exception:
             logger.exception("[poll] error")
 
-        await asyncio.sleep(POLL_INTERVAL)
+        try:
+            await asyncio.wait_for(_poll_wakeup.wait(), POLL_INTERVAL)
+        except asyncio.TimeoutError:
+            pass
+        # a burst of pushes (or a flood of fake ones) collapses into one
+        # sync per PUSH_MIN_GAP
+        gap = PUSH_MIN_GAP - (time.monotonic() - started)
+        if gap > 0:
+            await asyncio.sleep(gap)
+        _poll_wakeup.clear()
+
+# ─── GMAIL PUSH WEBHOOK ──────────────────────────────────────────────────────
+# anyone reaching an unauthenticated webhook could trigger Gmail syncs
+def push_enabled() -> bool:
+    return bool(PUSH_TOPIC and ((PUSH_AUDIENCE and PUSH_SERVICE_ACCOUNT) or PUSH_INSECURE))
+
+# fetches Google's signing certs; one session for every push
+_push_http = Request()
+
+# any Google account can mint a signed token for any audience, so the
+# signer must also be the subscription's service account
+def verify_push(token: str) -> bool:
+    try:
+        claims = id_token.verify_oauth2_token(token, _push_http, PUSH_AUDIENCE)
+    except ValueError:
+        return False
+    return bool(claims.get("email_verified")) and claims.get("email") == PUSH_SERVICE_ACCOUNT
+
+async def on_push(request: web.Request):
+    if not PUSH_INSECURE:
+        auth = request.headers.get("Authorization", "")
+        if not auth.startswith("Bearer "):
+            return web.Response(status=401)
+        if not await asyncio.to_thread(verify_push, auth[7:]):
+            return web.Response(status=401)
 
-async def reminder_loop(gid: str):
-    await asyncio.sleep(FIRST_REMINDER)
-    info = load_json(UNREAD_STORE_FILE, {}).get(gid)
-    if info and info.get("tg_msg_id"):
-        await bot.send_message(
-            CHAT_ID,
-            "📌 Reminder: you still have an unread message.",
-            reply_to_message_id=info["tg_msg_id"]
-        )
+    try:
+        envelope = orjson.loads(await request.read())
+        data     = orjson.loads(b64decode(envelope["message"]["data"]))
+    except Exception:
+        return web.Response(status=400)
+
+    # the poll loop already syncs from its own historyId; just run it now
+    logger.info("[push] mailbox changed (historyId %s)", data.get("historyId"))
+    _poll_wakeup.set()
+    return web.Response(status=204)
+
+async def start_push_server():
+    if not push_enabled():
+        logger.error("[push] PUSH_AUDIENCE or PUSH_SERVICE_ACCOUNT is not set; "
+                     "webhook disabled, polling only")
+        return
+    if PUSH_INSECURE:
+        logger.warning("[push] PUSH_INSECURE: accepting unauthenticated pushes")
+    app = web.Application()
+    app.router.add_post(PUSH_PATH, on_push)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    tls = None
+    if PUSH_TLS_CERT:
+        tls = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+        tls.load_cert_chain(PUSH_TLS_CERT, PUSH_TLS_KEY)
+    await web.TCPSite(runner, PUSH_HOST, PUSH_PORT, ssl_context=tls).start()
+    logger.info("[push] listening on %s://%s:%s%s",
+                "https" if tls else "http", PUSH_HOST, PUSH_PORT, PUSH_PATH)
+
+REMINDER_TEXTS = (
+    "📌 Reminder: you still have an unread message.",
+    "📌 Final reminder: please mark that message as read.",
+)
 
-    await asyncio.sleep(LOOP_REMINDER)
-    info = load_json(UNREAD_STORE_FILE, {}).get(gid)
-    if info and info.get("tg_msg_id"):
-        await bot.send_message(
-            CHAT_ID,
-            "📌 Final reminder: please mark that message as read.",
-            reply_to_message_id=info["tg_msg_id"]
-        )
+def schedule_reminder(gid: str, delay: float, stage: int):
+    heapq.heappush(_reminders, (time.time() + delay, gid, stage))
+    _reminder_wakeup.set()
+
+# re-queue reminders still due for notifications sent before a restart
+def restore_reminders():
+    now = time.time()
+    for gid, info in unread_store.items():
+        if not info.get("tg_msg_id"):
+            continue
+        first = info["time"] + FIRST_REMINDER
+        if now < first:
+            heapq.heappush(_reminders, (first, gid, 0))
+        elif now < first + LOOP_REMINDER:
+            heapq.heappush(_reminders, (first + LOOP_REMINDER, gid, 1))
+    _reminder_wakeup.set()
+
+# one task serves every pending reminder; messages marked as read are
+# simply gone from unread_store by the time their turn comes
+async def reminder_loop():
+    while True:
+        _reminder_wakeup.clear()
+        delay = _reminders[0][0] - time.time() if _reminders else None
+        if delay is None or delay > 0:
+            try:
+                await asyncio.wait_for(_reminder_wakeup.wait(), delay)
+            except asyncio.TimeoutError:
+                pass
+            continue
+
+        _, gid, stage = heapq.heappop(_reminders)
+        info = unread_store.get(gid)
+        if not (info and info.get("tg_msg_id")):
+            continue
+        try:
+            await bot.send_message(
+                bot_state.chat_id,
+                REMINDER_TEXTS[stage],
+                reply_to_message_id=info["tg_msg_id"]
+            )
+        except Exception:
+            logger.exception("[reminder] error")
+        if stage + 1 < len(REMINDER_TEXTS):
+            schedule_reminder(gid, LOOP_REMINDER, stage + 1)
 
 # ─── COMMAND: /myid ───────────────────────────────────────────────────────────
 @dp.message(F.text == "/myid")
@@ -495,14 +1079,36 @@ async def cmd_myid(m: Message):
 # ─── RUNNER ───────────────────────────────────────────────────────────────────
 if __name__ == "__main__":
     async def main():
-        global CHAT_ID, last_checked_ts, _poll_task
+        global _reminder_task, _creds_task
+        global _reminder_wakeup, _poll_wakeup, _gmail_lock, _wl_lock
+        # before 3.10 these bind to the loop current at creation, so they
+        # are made here, inside asyncio.run, not at import
+        _reminder_wakeup = asyncio.Event()
+        _poll_wakeup     = asyncio.Event()
+        _gmail_lock      = asyncio.Lock()
+        _wl_lock         = asyncio.Lock()
+        # every asyncio.to_thread call lands here
+        asyncio.get_running_loop().set_default_executor(
+            ThreadPoolExecutor(max_workers=IO_WORKERS, thread_name_prefix="io")
+        )
         # load previous state
-        CHAT_ID, last_checked_ts = load_state()
+        load_state()
+        unread_store.update(load_json(UNREAD_STORE_FILE, {}))
+        restore_reminders()
 
         # resume polling if we have valid creds + chat
-        if os.path.exists(CREDENTIALS_FILE) and CHAT_ID:
-            _poll_task = asyncio.create_task(poll_loop())
+        if os.path.exists(CREDENTIALS_FILE) and bot_state.chat_id:
+            bot_state.poll_task = asyncio.create_task(poll_loop())
+        _reminder_task = asyncio.create_task(reminder_loop())
+        _creds_task    = asyncio.create_task(creds_refresh_loop())
+        if PUSH_TOPIC:
+            await start_push_server()
 
-        await dp.start_polling(bot)
+        try:
+            await dp.start_polling(bot)
+        finally:
+            # don't lose changes still waiting for the debounced writer
+            if _store_writer:
+                await save_json_async(UNREAD_STORE_FILE, dict(unread_store))
 
     asyncio.run(main())